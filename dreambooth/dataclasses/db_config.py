@@ -31,6 +31,7 @@ class DreamboothConfig(BaseModel):
     attention: str = "xformers"
     cache_latents: bool = True
     clip_skip: int = 1
+    compile_optimizer: bool = False
     concepts_list: List[Dict] = []
     concepts_path: str = ""
     custom_model_name: str = ""
@@ -81,6 +82,7 @@ class DreamboothConfig(BaseModel):
     model_type: str = "v1x"
     noise_scheduler: str = "DDPM"
     num_train_epochs: int = 100
+    offload_optimizer_state: bool = False
     offset_noise: float = 0
     optimizer: str = "8bit AdamW"
     pad_tokens: bool = True
@@ -110,6 +112,7 @@ class DreamboothConfig(BaseModel):
     save_state_cancel: bool = False
     save_state_during: bool = False
     scheduler: str = "ddim"
+    shard_optimizer: bool = False
     shared_diffusers_path: str = ""
     shuffle_tags: bool = True
     snapshot: str = ""
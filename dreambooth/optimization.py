@@ -17,22 +17,34 @@
 # limitations under the License.
 """PyTorch optimizations for diffusion models."""
 
+import abc
+import copy
+import functools
+import importlib
 import math
-import traceback
+import os
+import types
+from array import array
+from dataclasses import dataclass
 from enum import Enum
-from typing import Optional, Union, List
+from typing import Callable, Dict, Optional, Tuple, Union, List
 
-from diffusers import DEISMultistepScheduler, UniPCMultistepScheduler, DDPMScheduler
+import torch
 from diffusers.utils import logging
+from packaging import version
 from torch.optim import Optimizer
 from torch.optim.lr_scheduler import (
-    LambdaLR,
     ConstantLR,
     LinearLR,
     CosineAnnealingLR,
     CosineAnnealingWarmRestarts,
 )
 
+try:
+    from torch.optim.lr_scheduler import LRScheduler
+except ImportError:  # torch < 2.0
+    from torch.optim.lr_scheduler import _LRScheduler as LRScheduler
+
 logger = logging.get_logger(__name__)
 
 
@@ -48,31 +60,222 @@ class SchedulerType(Enum):
     CONSTANT = "constant"
     CONSTANT_WITH_WARMUP = "constant_with_warmup"
 
-def get_rex_scheduler(optimizer: Optimizer, total_training_steps):
+
+class _ClosedFormLR(LRScheduler, abc.ABC):
+    """
+    Base class for schedulers whose LR is a pure function of the current step, scaled from the initial LR of each
+    param group. The factor is computed directly from `last_epoch` instead of going through a `LambdaLR` callback, so
+    stepping to an explicit step (as `UniversalScheduler` does) or resuming from a state dict gives the same LR.
+
+    If `precompute_steps` is set, the factors for steps 0..precompute_steps are computed once up front and looked up
+    while training. Steps outside that range fall back to `lr_factor`.
+    """
+
+    def __init__(self, optimizer: Optimizer, last_epoch: int = -1, precompute_steps: Optional[int] = None):
+        self.precompute_steps = precompute_steps
+        self._factors = self._build_factors()
+        super().__init__(optimizer, last_epoch)
+
+    @abc.abstractmethod
+    def lr_factor(self, step: int) -> float:
+        """The LR factor for `step`, relative to the initial LR of each param group."""
+
+    def get_lr(self) -> List[float]:
+        return self._get_closed_form_lr()
+
+    def _get_closed_form_lr(self) -> List[float]:
+        step = self.last_epoch
+        factors = self._factors
+        if factors is not None and 0 <= step < len(factors):
+            factor = factors[step]
+        else:
+            factor = self.lr_factor(step)
+        return [base_lr * factor for base_lr in self.base_lrs]
+
+    def _build_factors(self) -> Optional[array]:
+        if self.precompute_steps is None or self.precompute_steps < 0:
+            return None
+        return array("d", (self.lr_factor(step) for step in range(self.precompute_steps + 1)))
+
+    def state_dict(self) -> dict:
+        state = super().state_dict()
+        # The table is derived from the other attributes and can be large, so don't store it in checkpoints
+        state.pop("_factors", None)
+        return state
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        super().load_state_dict(state_dict)
+        self._factors = self._build_factors()
+
+
+class _WarmupLR(_ClosedFormLR):
+    """
+    Closed-form scheduler with a linear warmup from `min_lr` to the initial LR over `num_warmup_steps`.
+    """
+
+    def __init__(
+            self, optimizer: Optimizer, num_warmup_steps: int, min_lr: float, last_epoch: int = -1,
+            precompute_steps: Optional[int] = None
+    ):
+        self.num_warmup_steps = num_warmup_steps
+        self.min_lr = min_lr
+        super().__init__(optimizer, last_epoch, precompute_steps)
+
+    def warmup_factor(self, step: int) -> float:
+        return max(self.min_lr, float(step) / float(max(1, self.num_warmup_steps)))
+
+
+class RexLR(_ClosedFormLR):
+    """
+    REx (Relative Exploration) schedule, see https://arxiv.org/abs/2107.04197
+    """
+
+    def __init__(
+            self, optimizer: Optimizer, total_training_steps: int, last_epoch: int = -1,
+            precompute_steps: Optional[int] = None
+    ):
+        self.total_training_steps = total_training_steps
+        self.max_lr = 1
+        self.min_lr = 0.00000001
+        self.d = 0.9
+        # Constant across steps, so work them out once here rather than in lr_factor
+        self.amplitude = self.max_lr - self.min_lr
+        self.one_minus_d = 1 - self.d
+        super().__init__(optimizer, last_epoch, precompute_steps)
+
+    def lr_factor(self, step: int) -> float:
+        if step < self.total_training_steps:
+            remaining = 1 - step / self.total_training_steps
+            return self.min_lr + self.amplitude * (remaining / (self.one_minus_d + self.d * remaining))
+        else:
+            return self.min_lr
+
+
+class ConstantWarmupLR(_WarmupLR):
+    """
+    Constant LR after a linear warmup.
+    """
+
+    def lr_factor(self, step: int) -> float:
+        if step < self.num_warmup_steps:
+            return self.warmup_factor(step)
+        return 1.0
+
+
+class LinearWarmupLR(_WarmupLR):
+    """
+    Linear decay to 0 over the remaining training steps, after a linear warmup.
+    """
+
+    def __init__(
+            self, optimizer: Optimizer, num_warmup_steps: int, num_training_steps: int, min_lr: float,
+            last_epoch: int = -1,
+            precompute_steps: Optional[int] = None
+    ):
+        self.num_training_steps = num_training_steps
+        super().__init__(optimizer, num_warmup_steps, min_lr, last_epoch, precompute_steps)
+
+    def lr_factor(self, step: int) -> float:
+        if step < self.num_warmup_steps:
+            return self.warmup_factor(step)
+        return max(
+            0.0,
+            float(self.num_training_steps - step)
+            / float(max(1, self.num_training_steps - self.num_warmup_steps)),
+        )
+
+
+class CosineWarmupLR(_WarmupLR):
+    """
+    Cosine decay over `num_cycles` waves, after a linear warmup.
+    """
+
+    def __init__(
+            self, optimizer: Optimizer, num_warmup_steps: int, num_training_steps: int, min_lr: float,
+            num_cycles: float = 0.5, last_epoch: int = -1,
+            precompute_steps: Optional[int] = None
+    ):
+        self.num_training_steps = num_training_steps
+        self.num_cycles = num_cycles
+        self.two_pi_cycles = math.pi * float(num_cycles) * 2.0
+        self.inv_decay_steps = 1.0 / float(max(1, num_training_steps - num_warmup_steps))
+        super().__init__(optimizer, num_warmup_steps, min_lr, last_epoch, precompute_steps)
+
+    def lr_factor(self, step: int) -> float:
+        if step < self.num_warmup_steps:
+            return self.warmup_factor(step)
+        progress = (step - self.num_warmup_steps) * self.inv_decay_steps
+        return max(0.0, 0.5 * (1.0 + math.cos(self.two_pi_cycles * progress)))
+
+
+class CosineHardRestartsLR(_WarmupLR):
+    """
+    Cosine decay with `num_cycles` hard restarts, after a linear warmup.
+    """
+
+    def __init__(
+            self, optimizer: Optimizer, num_warmup_steps: int, num_training_steps: int, min_lr: float,
+            num_cycles: int = 1, last_epoch: int = -1,
+            precompute_steps: Optional[int] = None
+    ):
+        self.num_training_steps = num_training_steps
+        self.num_cycles = num_cycles
+        self.cycles = float(num_cycles)
+        self.inv_decay_steps = 1.0 / float(max(1, num_training_steps - num_warmup_steps))
+        super().__init__(optimizer, num_warmup_steps, min_lr, last_epoch, precompute_steps)
+
+    def lr_factor(self, step: int) -> float:
+        if step < self.num_warmup_steps:
+            return self.warmup_factor(step)
+        progress = (step - self.num_warmup_steps) * self.inv_decay_steps
+        if progress >= 1.0:
+            return 0.0
+        return max(0.0, 0.5 * (1.0 + math.cos(math.pi * ((self.cycles * progress) % 1.0))))
+
+
+class PolynomialDecayWarmupLR(_WarmupLR):
+    """
+    Polynomial decay from the initial LR to `lr_end`, after a linear warmup.
+    """
+
+    def __init__(
+            self, optimizer: Optimizer, num_warmup_steps: int, num_training_steps: int, min_lr: float,
+            lr_end: float = 1e-7, power: float = 1.0, last_epoch: int = -1,
+            precompute_steps: Optional[int] = None
+    ):
+        self.num_training_steps = num_training_steps
+        self.lr_init = optimizer.defaults["lr"]
+        self.lr_end = lr_end
+        self.power = power
+        self.lr_range = self.lr_init - lr_end
+        # Warmup may cover the whole run, the decay phase is then a single step
+        self.decay_steps = max(1, num_training_steps - num_warmup_steps)
+        self.inv_lr_init = 1.0 / self.lr_init  # as the base LR is lr_init
+        super().__init__(optimizer, num_warmup_steps, min_lr, last_epoch, precompute_steps)
+
+    def lr_factor(self, step: int) -> float:
+        if step < self.num_warmup_steps:
+            return self.warmup_factor(step)
+        elif step > self.num_training_steps:
+            return self.lr_end * self.inv_lr_init
+        else:
+            pct_remaining = 1 - (step - self.num_warmup_steps) / self.decay_steps
+            return (self.lr_range * pct_remaining ** self.power + self.lr_end) * self.inv_lr_init
+
+
+def get_rex_scheduler(optimizer: Optimizer, total_training_steps, precompute_steps: Optional[int] = None):
     """
     Returns a learning rate scheduler based on the REx (Relative Exploration) algorithm.
 
     Args:
         optimizer (Optimizer): The optimizer to use for training.
         total_training_steps (int): The total number of training steps.
+        precompute_steps (int, optional): If set, the LR factors up to this step are computed once up front.
 
     Returns:
-        A tuple containing the original optimizer object and a lambda function that can be used to create a PyTorch learning rate scheduler.
-    """
-    def lr_lambda(current_step: int):
-        # https://arxiv.org/abs/2107.04197
-        max_lr = 1
-        min_lr = 0.00000001
-        d = 0.9
-
-        if current_step < total_training_steps:
-            progress = current_step / total_training_steps
-            div = (1 - d) + (d * (1 - progress))
-            return min_lr + (max_lr - min_lr) * ((1 - progress) / div)
-        else:
-            return min_lr
-
-    return LambdaLR(optimizer, lr_lambda)
+        `RexLR` with the appropriate schedule.
+    """
+    return RexLR(optimizer, total_training_steps, precompute_steps=precompute_steps)
 
 
 # region Newer Schedulers
@@ -166,7 +369,7 @@ def get_constant_schedule(
 
 # region originals
 def get_constant_schedule_with_warmup(
-        optimizer: Optimizer, num_warmup_steps: int, min_lr: float
+        optimizer: Optimizer, num_warmup_steps: int, min_lr: float, precompute_steps: Optional[int] = None
 ):
     """
     Create a schedule with a constant learning rate preceded by a warmup period during which the learning rate
@@ -179,22 +382,17 @@ def get_constant_schedule_with_warmup(
             The number of steps for the warmup phase.
         min_lr (`float`, *optional*, defaults to 1e-6):
             The minimum learning rate to use after the number of max iterations is reached.
+        precompute_steps (`int`, *optional*):
+            If set, the LR factors up to this step are computed once up front instead of on every step.
 
     Return:
-        `torch.optim.lr_scheduler.LambdaLR` with the appropriate schedule.
+        `ConstantWarmupLR` with the appropriate schedule.
     """
-
-    def lr_lambda(current_step: int):
-        if current_step < num_warmup_steps:
-            lamb = float(current_step) / float(max(1, num_warmup_steps))
-            return max(min_lr, lamb)
-        return 1.0
-
-    return LambdaLR(optimizer, lr_lambda, last_epoch=-1)
+    return ConstantWarmupLR(optimizer, num_warmup_steps, min_lr, last_epoch=-1, precompute_steps=precompute_steps)
 
 
 def get_linear_schedule_with_warmup(
-        optimizer, num_warmup_steps, num_training_steps, min_lr, last_epoch=-1
+        optimizer, num_warmup_steps, num_training_steps, min_lr, last_epoch=-1, precompute_steps=None
 ):
     """
     Create a schedule with a learning rate that decreases linearly from the initial lr set in the optimizer to 0, after
@@ -211,22 +409,14 @@ def get_linear_schedule_with_warmup(
             The minimum learning rate to use after the number of max iterations is reached.
         last_epoch (`int`, *optional*, defaults to -1):
             The index of the last epoch when resuming training.
+        precompute_steps (`int`, *optional*):
+            If set, the LR factors up to this step are computed once up front instead of on every step.
 
 
     Return:
-        `torch.optim.lr_scheduler.LambdaLR` with the appropriate schedule.
+        `LinearWarmupLR` with the appropriate schedule.
     """
-
-    def lr_lambda(current_step: int):
-        if current_step < num_warmup_steps:
-            return max(min_lr, float(current_step) / float(max(1, num_warmup_steps)))
-        return max(
-            0.0,
-            float(num_training_steps - current_step)
-            / float(max(1, num_training_steps - num_warmup_steps)),
-        )
-
-    return LambdaLR(optimizer, lr_lambda, last_epoch)
+    return LinearWarmupLR(optimizer, num_warmup_steps, num_training_steps, min_lr, last_epoch, precompute_steps)
 
 
 def get_cosine_schedule_with_warmup(
@@ -236,6 +426,7 @@ def get_cosine_schedule_with_warmup(
         min_lr: float,
         num_cycles: float = 0.5,
         last_epoch: int = -1,
+        precompute_steps: Optional[int] = None,
 ):
     """
     Create a schedule with a learning rate that decreases following the values of the cosine function between the
@@ -256,22 +447,15 @@ def get_cosine_schedule_with_warmup(
             following a half-cosine).
         last_epoch (`int`, *optional*, defaults to -1):
             The index of the last epoch when resuming training.
+        precompute_steps (`int`, *optional*):
+            If set, the LR factors up to this step are computed once up front instead of on every step.
 
     Return:
-        `torch.optim.lr_scheduler.LambdaLR` with the appropriate schedule.
+        `CosineWarmupLR` with the appropriate schedule.
     """
-
-    def lr_lambda(current_step):
-        if current_step < num_warmup_steps:
-            return max(min_lr, float(current_step) / float(max(1, num_warmup_steps)))
-        progress = float(current_step - num_warmup_steps) / float(
-            max(1, num_training_steps - num_warmup_steps)
-        )
-        return max(
-            0.0, 0.5 * (1.0 + math.cos(math.pi * float(num_cycles) * 2.0 * progress))
-        )
-
-    return LambdaLR(optimizer, lr_lambda, last_epoch)
+    return CosineWarmupLR(
+        optimizer, num_warmup_steps, num_training_steps, min_lr, num_cycles, last_epoch, precompute_steps
+    )
 
 
 def get_cosine_with_hard_restarts_schedule_with_warmup(
@@ -281,6 +465,7 @@ def get_cosine_with_hard_restarts_schedule_with_warmup(
         min_lr: float,
         num_cycles: int = 1,
         last_epoch: int = -1,
+        precompute_steps: Optional[int] = None,
 ):
     """
     Create a schedule with a learning rate that decreases following the values of the cosine function between the
@@ -300,25 +485,15 @@ def get_cosine_with_hard_restarts_schedule_with_warmup(
             The number of hard restarts to use.
         last_epoch (`int`, *optional*, defaults to -1):
             The index of the last epoch when resuming training.
+        precompute_steps (`int`, *optional*):
+            If set, the LR factors up to this step are computed once up front instead of on every step.
 
     Return:
-        `torch.optim.lr_scheduler.LambdaLR` with the appropriate schedule.
+        `CosineHardRestartsLR` with the appropriate schedule.
     """
-
-    def lr_lambda(current_step):
-        if current_step < num_warmup_steps:
-            return max(min_lr, float(current_step) / float(max(1, num_warmup_steps)))
-        progress = float(current_step - num_warmup_steps) / float(
-            max(1, num_training_steps - num_warmup_steps)
-        )
-        if progress >= 1.0:
-            return 0.0
-        return max(
-            0.0,
-            0.5 * (1.0 + math.cos(math.pi * ((float(num_cycles) * progress) % 1.0))),
-        )
-
-    return LambdaLR(optimizer, lr_lambda, last_epoch)
+    return CosineHardRestartsLR(
+        optimizer, num_warmup_steps, num_training_steps, min_lr, num_cycles, last_epoch, precompute_steps
+    )
 
 
 def get_polynomial_decay_schedule_with_warmup(
@@ -329,6 +504,7 @@ def get_polynomial_decay_schedule_with_warmup(
         lr_end=1e-7,
         power=1.0,
         last_epoch=-1,
+        precompute_steps=None,
 ):
     """
     Create a schedule with a learning rate that decreases as a polynomial decay from the initial lr set in the
@@ -350,13 +526,15 @@ def get_polynomial_decay_schedule_with_warmup(
             Power factor.
         last_epoch (`int`, *optional*, defaults to -1):
             The index of the last epoch when resuming training.
+        precompute_steps (`int`, *optional*):
+            If set, the LR factors up to this step are computed once up front instead of on every step.
 
     Note: *power* defaults to 1.0 as in the fairseq implementation, which in turn is based on the original BERT
     implementation at
     https://github.com/google-research/bert/blob/f39e881b169b9d53bea03d2d341b31707a6c052b/optimization.py#L37
 
     Return:
-        `torch.optim.lr_scheduler.LambdaLR` with the appropriate schedule.
+        `PolynomialDecayWarmupLR` with the appropriate schedule.
 
     """
 
@@ -366,24 +544,107 @@ def get_polynomial_decay_schedule_with_warmup(
             f"lr_end ({lr_end}) must be be smaller than initial lr ({lr_init})"
         )
 
-    def lr_lambda(current_step: int):
-        if current_step < num_warmup_steps:
-            return max(min_lr, float(current_step) / float(max(1, num_warmup_steps)))
-        elif current_step > num_training_steps:
-            return lr_end / lr_init  # as LambdaLR multiplies by lr_init
-        else:
-            lr_range = lr_init - lr_end
-            decay_steps = num_training_steps - num_warmup_steps
-            pct_remaining = 1 - (current_step - num_warmup_steps) / decay_steps
-            decay = lr_range * pct_remaining ** power + lr_end
-            return decay / lr_init  # as LambdaLR multiplies by lr_init
-
-    return LambdaLR(optimizer, lr_lambda, last_epoch)
+    return PolynomialDecayWarmupLR(
+        optimizer, num_warmup_steps, num_training_steps, min_lr, lr_end, power, last_epoch, precompute_steps
+    )
 
 
 # endregion
 
 
+_MAX_PRECOMPUTED_STEPS = 200_000
+
+
+@dataclass
+class SchedulerCtx:
+    """
+    Arguments shared by the schedulers built through `get_scheduler`.
+    """
+    num_warmup_steps: Optional[int]
+    total_training_steps: Optional[int]
+    min_lr: float
+    min_lr_scale: float
+    num_cycles: int
+    power: float
+    factor: float
+    scale_pos: float
+    unet_lr: float
+    tenc_lr: float
+
+    @property
+    def break_steps(self) -> int:
+        # Only the newer schedulers have an adjustment point
+        return int(self.total_training_steps * self.scale_pos)
+
+    @property
+    def precompute_steps(self) -> Optional[int]:
+        # Serve LR factors from a table (8 bytes per step) unless the run is very long
+        if self.total_training_steps <= _MAX_PRECOMPUTED_STEPS:
+            return self.total_training_steps
+        return None
+
+
+# Schedulers with a warmup phase
+_OG_SCHEDULERS = frozenset({
+    SchedulerType.CONSTANT_WITH_WARMUP,
+    SchedulerType.LINEAR_WITH_WARMUP,
+    SchedulerType.COSINE,
+    SchedulerType.COSINE_WITH_RESTARTS,
+    SchedulerType.POLYNOMIAL,
+})
+
+
+_SCHED_DISPATCH: Dict[SchedulerType, Callable[[Optimizer, SchedulerCtx], LRScheduler]] = {
+    # Newer schedulers
+    SchedulerType.CONSTANT: lambda opt, ctx: get_constant_schedule(opt, ctx.factor, ctx.break_steps),
+    SchedulerType.LINEAR: lambda opt, ctx: get_linear_schedule(opt, ctx.factor, ctx.break_steps),
+    SchedulerType.COSINE_ANNEALING: lambda opt, ctx: get_cosine_annealing_scheduler(
+        opt, ctx.break_steps, ctx.min_lr
+    ),
+    SchedulerType.COSINE_ANNEALING_WITH_RESTARTS: lambda opt, ctx: get_cosine_annealing_warm_restarts_scheduler(
+        opt, int(ctx.break_steps / 2), eta_min=ctx.min_lr
+    ),
+    # OG schedulers
+    SchedulerType.CONSTANT_WITH_WARMUP: lambda opt, ctx: get_constant_schedule_with_warmup(
+        opt, num_warmup_steps=ctx.num_warmup_steps, min_lr=ctx.min_lr_scale, precompute_steps=ctx.precompute_steps
+    ),
+    SchedulerType.LINEAR_WITH_WARMUP: lambda opt, ctx: get_linear_schedule_with_warmup(
+        opt,
+        ctx.num_warmup_steps,
+        ctx.total_training_steps,
+        min_lr=ctx.min_lr_scale,
+        precompute_steps=ctx.precompute_steps,
+    ),
+    SchedulerType.COSINE_WITH_RESTARTS: lambda opt, ctx: get_cosine_with_hard_restarts_schedule_with_warmup(
+        opt,
+        num_warmup_steps=ctx.num_warmup_steps,
+        num_training_steps=ctx.total_training_steps,
+        min_lr=ctx.min_lr_scale,
+        num_cycles=ctx.num_cycles,
+        precompute_steps=ctx.precompute_steps,
+    ),
+    SchedulerType.POLYNOMIAL: lambda opt, ctx: get_polynomial_decay_schedule_with_warmup(
+        opt,
+        num_warmup_steps=ctx.num_warmup_steps,
+        num_training_steps=ctx.total_training_steps,
+        min_lr=ctx.min_lr_scale,
+        power=ctx.power,
+        precompute_steps=ctx.precompute_steps,
+    ),
+    SchedulerType.COSINE: lambda opt, ctx: get_cosine_schedule_with_warmup(
+        opt,
+        num_warmup_steps=ctx.num_warmup_steps,
+        num_training_steps=ctx.total_training_steps,
+        min_lr=ctx.min_lr_scale,
+        num_cycles=ctx.num_cycles,
+        precompute_steps=ctx.precompute_steps,
+    ),
+    SchedulerType.REX: lambda opt, ctx: get_rex_scheduler(
+        opt, total_training_steps=ctx.total_training_steps, precompute_steps=ctx.precompute_steps
+    ),
+}
+
+
 def get_scheduler(
         name: Union[str, SchedulerType],
         optimizer: Optimizer,
@@ -432,65 +693,31 @@ def get_scheduler(
 
     """
     name = SchedulerType(name)
-    break_steps = int(total_training_steps * scale_pos)
-
-    # Newer schedulers
-    if name == SchedulerType.CONSTANT:
-        return get_constant_schedule(optimizer, factor, break_steps)
-
-    if name == SchedulerType.LINEAR:
-        return get_linear_schedule(optimizer, factor, break_steps)
-
-    if name == SchedulerType.COSINE_ANNEALING:
-        return get_cosine_annealing_scheduler(optimizer, break_steps, min_lr)
-
-    if name == SchedulerType.COSINE_ANNEALING_WITH_RESTARTS:
-        return get_cosine_annealing_warm_restarts_scheduler(
-            optimizer, int(break_steps / 2), eta_min=min_lr
-        )
-
-    # OG schedulers
-    if name == SchedulerType.CONSTANT_WITH_WARMUP:
-        return get_constant_schedule_with_warmup(
-            optimizer, num_warmup_steps=num_warmup_steps, min_lr=min_lr_scale
-        )
+    if not total_training_steps or total_training_steps <= 0:
+        raise ValueError(f"{name.value} scheduler requires total_training_steps > 0, got {total_training_steps}")
+    if name in _OG_SCHEDULERS and (num_warmup_steps is None or num_warmup_steps < 0):
+        raise ValueError(f"{name.value} scheduler requires num_warmup_steps >= 0, got {num_warmup_steps}")
+
+    ctx = SchedulerCtx(
+        num_warmup_steps=num_warmup_steps,
+        total_training_steps=total_training_steps,
+        min_lr=min_lr,
+        min_lr_scale=min_lr_scale,
+        num_cycles=num_cycles,
+        power=power,
+        factor=factor,
+        scale_pos=scale_pos,
+        unet_lr=unet_lr,
+        tenc_lr=tenc_lr,
+    )
 
-    if name == SchedulerType.LINEAR_WITH_WARMUP:
-        return get_linear_schedule_with_warmup(
-            optimizer, num_warmup_steps, total_training_steps, min_lr=min_lr_scale
-        )
+    try:
+        build = _SCHED_DISPATCH[name]
+    except KeyError:
+        raise ValueError(f"Unsupported scheduler: {name.value}") from None
+    return build(optimizer, ctx)
 
-    if name == SchedulerType.COSINE_WITH_RESTARTS:
-        return get_cosine_with_hard_restarts_schedule_with_warmup(
-            optimizer,
-            num_warmup_steps=num_warmup_steps,
-            num_training_steps=total_training_steps,
-            min_lr=min_lr_scale,
-            num_cycles=num_cycles,
-        )
-    if name == SchedulerType.POLYNOMIAL:
-        return get_polynomial_decay_schedule_with_warmup(
-            optimizer,
-            num_warmup_steps=num_warmup_steps,
-            num_training_steps=total_training_steps,
-            min_lr=min_lr_scale,
-            power=power,
-        )
-    if name == SchedulerType.COSINE:
-        return get_cosine_schedule_with_warmup(
-            optimizer,
-            num_warmup_steps=num_warmup_steps,
-            num_training_steps=total_training_steps,
-            min_lr=min_lr_scale,
-            num_cycles=num_cycles,
-        )
 
-    if name == SchedulerType.REX:
-        return get_rex_scheduler(
-            optimizer, 
-            total_training_steps=total_training_steps      
-        )
-        
 class UniversalScheduler:
     def __init__(
             self,
@@ -508,15 +735,7 @@ class UniversalScheduler:
             tenc_lr: float = 1.0,
     ):
         self.current_step = 0
-        og_schedulers = [
-            "constant_with_warmup",
-            "linear_with_warmup",
-            "cosine",
-            "cosine_with_restarts",
-            "polynomial",
-        ]
-
-        self.is_torch_scheduler = name in og_schedulers
+        self.is_torch_scheduler = SchedulerType(name) in _OG_SCHEDULERS
 
         self.total_steps = total_training_steps if not self.is_torch_scheduler else total_epochs
 
@@ -535,12 +754,8 @@ class UniversalScheduler:
         )
 
     def step(self, steps: int = 1, is_epoch: bool = False):
-        if self.is_torch_scheduler and is_epoch:
-            self.current_step += steps
-            self.scheduler.step(self.current_step)
-        else:
-            self.current_step += steps
-            self.scheduler.step(self.current_step)
+        self.current_step += steps
+        self.scheduler.step(self.current_step)
 
     def state_dict(self) -> dict:
         return self.scheduler.state_dict()
@@ -563,230 +778,483 @@ def log_dadapt(disable: bool = True):
         return 5
 
 
-def get_optimizer(optimizer: str, learning_rate: float, weight_decay: float, params_to_optimize):
+# Options shared by all D-Adaptation optimizers
+_DADAPT_KW = dict(log_every=log_dadapt(True), d0=1e-6)
+
+
+def _fsdp_active() -> bool:
+    """
+    Whether training runs under FSDP, which D-Adaptation needs to know to reduce its estimates across ranks.
+    Accelerate enables FSDP from the launch config, which it exposes through ACCELERATE_USE_FSDP.
+    """
+    if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+        return False
+    return os.environ.get("ACCELERATE_USE_FSDP", "false").lower() in ("1", "true")
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_import(module: str, name: str):
     try:
-        if optimizer == "Adafactor":
-            from transformers.optimization import Adafactor
-            return Adafactor(
-                params_to_optimize,
-                lr=learning_rate,
-                clip_threshold=1.0,
-                decay_rate=-0.8,
-                weight_decay=weight_decay,
-                relative_step=False,
-                scale_parameter=True,
-                warmup_init=False,
-            )
-
-        elif optimizer == "CAME":
-            from pytorch_optimizer import CAME
-            return CAME(
-                params_to_optimize,
-                lr=learning_rate,
-                weight_decay=weight_decay,
-                weight_decouple=True,
-                fixed_decay=False,
-                clip_threshold=1.0,
-                ams_bound=False,
-            )
-
-        elif optimizer == "8bit AdamW":
-            from bitsandbytes.optim import AdamW8bit
-            return AdamW8bit(
-                params_to_optimize,
-                lr=learning_rate,
-                weight_decay=weight_decay,
-                percentile_clipping=100,
-                min_8bit_size=4096,
-                block_wise=True,
-                amsgrad=False,
-                is_paged=False,
-            )
-
-        elif optimizer == "Paged 8bit AdamW":
-            from bitsandbytes.optim import PagedAdamW8bit
-            return PagedAdamW8bit(
-                params_to_optimize,
-                lr=learning_rate,
-                betas=(0.9, 0.999),
-                eps=1e-8,
-                weight_decay=weight_decay,
-                percentile_clipping=100,
-                block_wise=True,
-                amsgrad=False,
-                paged=True,
-            )
-
-        elif optimizer == "Apollo":
-            from pytorch_optimizer import Apollo
-            return Apollo(
-                params_to_optimize,
-                lr=learning_rate,
-                weight_decay=weight_decay,
-                weight_decay_type="l2",
-                init_lr=None,
-                rebound="constant",
-            )
-            
-        elif optimizer == "Lion":
-            from pytorch_optimizer import Lion
-            return Lion(
-                params_to_optimize,
-                lr=learning_rate,
-                weight_decay=weight_decay,
-                weight_decouple=True,
-                fixed_decay=False,
-                use_gc=False,
-                adanorm=False,
-            )
-
-        elif optimizer == "8bit Lion":
-            from bitsandbytes.optim import Lion8bit
-            return Lion8bit(
-                params_to_optimize,
-                lr=learning_rate,
-                betas=(0.9, 0.99),
-                weight_decay=weight_decay,
-                is_paged=False,
-                percentile_clipping=100,
-                block_wise=True,
-                min_8bit_size=4096,
-            )
-
-        elif optimizer == "Paged 8bit Lion":
-            from bitsandbytes.optim import PagedLion8bit
-            return PagedLion8bit(
-                params_to_optimize,
-                lr=learning_rate,
-                betas=(0.9, 0.99),
-                weight_decay=0,
-                percentile_clipping=100,
-                block_wise=True,
-                is_paged=True,
-                min_8bit_size=4096,
-            )
-
-        elif optimizer == "AdamW Dadaptation":
-            from dadaptation import DAdaptAdam
-            return DAdaptAdam(
-                params_to_optimize,
-                lr=learning_rate,
-                weight_decay=weight_decay,
-                decouple=True,
-                use_bias_correction=True,
-                log_every=log_dadapt(True),
-                fsdp_in_use=False,
-            )
-
-        elif optimizer == "Lion Dadaptation":
-            from dadaptation import DAdaptLion
-            return DAdaptLion(
-                params_to_optimize,
-                lr=learning_rate,
-                weight_decay=weight_decay,
-                log_every=log_dadapt(True),
-                fsdp_in_use=False,
-                d0=0.000001,
-            )
-
-        elif optimizer == "Adan Dadaptation":
-            from dadaptation import DAdaptAdan
-            return DAdaptAdan(
-                params_to_optimize,
-                lr=learning_rate,
-                weight_decay=weight_decay,
-                log_every=log_dadapt(True),
-                no_prox=False,
-                d0=0.000001,
-            )
-        
-        elif optimizer == "AdanIP Dadaptation":
-            from dadaptation.experimental import DAdaptAdanIP
-            return DAdaptAdanIP(
-                params_to_optimize,
-                lr=learning_rate,
-                weight_decay=weight_decay,
-                log_every=log_dadapt(True),
-                no_prox=False,
-                d0=0.000001
-            )
-        
-        elif optimizer == "SGD Dadaptation":
-            from dadaptation import DAdaptSGD
-            return DAdaptSGD(
-                params_to_optimize,
-                lr=learning_rate,
-                weight_decay=weight_decay,
-                log_every=log_dadapt(True),
-                momentum=0.0,
-                fsdp_in_use=False,
-                d0=0.000001,
-            )
-            
-        elif optimizer == "Prodigy":
-            from pytorch_optimizer import Prodigy
-            return Prodigy(
-                params_to_optimize,
-                lr=learning_rate,
-                weight_decay=weight_decay,
-                safeguard_warmup=False,
-                d0=1e-6,
-                d_coef=1.0,
-                bias_correction=False,
-                fixed_decay=False,
-                weight_decouple=True,
-                )
-
-
-        
-        elif optimizer == "Sophia":
-            from pytorch_optimizer import SophiaH
-            return SophiaH(
-                params_to_optimize,
-                lr=learning_rate,
-                weight_decay=weight_decay,
-                weight_decouple=True,
-                fixed_decay=False,
-                hessian_distribution="gaussian",
-                p=0.01,
-            )
-
-        elif optimizer == "Tiger":
-            from pytorch_optimizer import Tiger
-            return Tiger(
-                params_to_optimize,
-                lr=learning_rate,
-                beta=0.965,
-                weight_decay=0.01,
-                weight_decouple=True,
-                fixed_decay=False,
-            )
+        return getattr(importlib.import_module(module), name), None
+    except (ImportError, AttributeError) as e:
+        return None, e
+
+
+def _cached_import(module: str, name: str):
+    # Failures are cached as well, so a missing backend doesn't rescan sys.path every time it's requested.
+    # The original exception is chained, so its traceback still shows where the backend's import failed.
+    cls, error = _resolve_import(module, name)
+    if cls is None:
+        raise ImportError(f"cannot import name '{name}' from '{module}': {error}") from error
+    return cls
+
+
+def _build_adafactor(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        clip_threshold=1.0,
+        decay_rate=-0.8,
+        relative_step=False,
+        scale_parameter=True,
+        warmup_init=False,
+    )
 
-    except Exception as e:
-        logger.warning(f"Exception importing {optimizer}: {e}")
-        traceback.print_exc()
-        print(str(e))
-        print("WARNING: Using default optimizer (AdamW from Torch)")
-        optimizer = "Torch AdamW"
-
-    from torch.optim import AdamW
-    return AdamW(
-        params_to_optimize,
-        lr=learning_rate,
-        weight_decay=weight_decay,
+
+def _build_came(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        weight_decouple=True,
+        fixed_decay=False,
+        clip_threshold=1.0,
+        ams_bound=False,
     )
 
 
-def get_noise_scheduler(args):
-    if args.noise_scheduler == "DEIS":
-        scheduler_class = DEISMultistepScheduler
+def _build_adamw_8bit(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        percentile_clipping=100,
+        min_8bit_size=4096,
+        block_wise=True,
+        amsgrad=False,
+        is_paged=False,
+    )
 
-    elif args.noise_scheduler == "UniPC":
-        scheduler_class = UniPCMultistepScheduler
 
-    else:
-        scheduler_class = DDPMScheduler
+def _build_paged_adamw_8bit(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        betas=(0.9, 0.999),
+        eps=1e-8,
+        percentile_clipping=100,
+        block_wise=True,
+        amsgrad=False,
+        paged=True,
+    )
+
+
+def _build_apollo(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        weight_decay_type="l2",
+        init_lr=None,
+        rebound="constant",
+    )
+
+
+def _build_lion(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        weight_decouple=True,
+        fixed_decay=False,
+        use_gc=False,
+        adanorm=False,
+    )
+
+
+def _build_lion_8bit(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        betas=(0.9, 0.99),
+        is_paged=False,
+        percentile_clipping=100,
+        block_wise=True,
+        min_8bit_size=4096,
+    )
+
 
-    return scheduler_class.from_pretrained(
-        args.get_pretrained_model_name_or_path(), subfolder="scheduler"
+def _build_paged_lion_8bit(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        betas=(0.9, 0.99),
+        weight_decay=0,
+        percentile_clipping=100,
+        block_wise=True,
+        is_paged=True,
+        min_8bit_size=4096,
     )
+
+
+def _build_adamw_dadapt(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        decouple=True,
+        use_bias_correction=True,
+        fsdp_in_use=_fsdp_active(),
+        **_DADAPT_KW,
+    )
+
+
+def _build_lion_dadapt(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        fsdp_in_use=_fsdp_active(),
+        **_DADAPT_KW,
+    )
+
+
+def _build_adan_dadapt(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        no_prox=False,
+        **_DADAPT_KW,
+    )
+
+
+def _build_sgd_dadapt(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        momentum=0.0,
+        fsdp_in_use=_fsdp_active(),
+        **_DADAPT_KW,
+    )
+
+
+def _build_prodigy(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        safeguard_warmup=False,
+        d0=1e-6,
+        d_coef=1.0,
+        bias_correction=False,
+        fixed_decay=False,
+        weight_decouple=True,
+    )
+
+
+def _build_sophia(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        weight_decouple=True,
+        fixed_decay=False,
+        hessian_distribution="gaussian",
+        p=0.01,
+    )
+
+
+def _build_tiger(optimizer_cls: functools.partial):
+    return optimizer_cls(
+        beta=0.965,
+        weight_decay=0.01,
+        weight_decouple=True,
+        fixed_decay=False,
+    )
+
+
+def _build_torch_adamw(optimizer_cls: functools.partial):
+    # The fused kernel updates every param in one launch, but needs CUDA params on a Volta or newer GPU.
+    # Otherwise torch picks the multi-tensor (foreach) implementation by itself.
+    if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 7:
+        try:
+            return optimizer_cls(fused=True)
+        except (TypeError, RuntimeError, ValueError) as e:
+            logger.debug(f"Fused AdamW unavailable, using the default implementation: {e}")
+
+    return optimizer_cls()
+
+
+# Optimizer name -> (module, class name, factory). The class is only imported once its optimizer is selected.
+_OPTIMIZER_FACTORIES: Dict[str, Tuple[str, str, Callable[[functools.partial], Optimizer]]] = {
+    "Adafactor": ("transformers.optimization", "Adafactor", _build_adafactor),
+    "CAME": ("pytorch_optimizer", "CAME", _build_came),
+    "8bit AdamW": ("bitsandbytes.optim", "AdamW8bit", _build_adamw_8bit),
+    "Paged 8bit AdamW": ("bitsandbytes.optim", "PagedAdamW8bit", _build_paged_adamw_8bit),
+    "Apollo": ("pytorch_optimizer", "Apollo", _build_apollo),
+    "Lion": ("pytorch_optimizer", "Lion", _build_lion),
+    "8bit Lion": ("bitsandbytes.optim", "Lion8bit", _build_lion_8bit),
+    "Paged 8bit Lion": ("bitsandbytes.optim", "PagedLion8bit", _build_paged_lion_8bit),
+    "AdamW Dadaptation": ("dadaptation", "DAdaptAdam", _build_adamw_dadapt),
+    "Lion Dadaptation": ("dadaptation", "DAdaptLion", _build_lion_dadapt),
+    "Adan Dadaptation": ("dadaptation", "DAdaptAdan", _build_adan_dadapt),
+    "AdanIP Dadaptation": ("dadaptation.experimental", "DAdaptAdanIP", _build_adan_dadapt),
+    "SGD Dadaptation": ("dadaptation", "DAdaptSGD", _build_sgd_dadapt),
+    "Prodigy": ("pytorch_optimizer", "Prodigy", _build_prodigy),
+    "Sophia": ("pytorch_optimizer", "SophiaH", _build_sophia),
+    "Tiger": ("pytorch_optimizer", "Tiger", _build_tiger),
+    "Torch AdamW": ("torch.optim", "AdamW", _build_torch_adamw),
+}
+
+# Used for unknown names and when the selected optimizer can't be created
+_DEFAULT_OPTIMIZER = "Torch AdamW"
+
+# Optimizers that failed to build and have been reported already
+_reported_failures = set()
+
+
+def _unique_params(params, seen: set) -> list:
+    unique = []
+    for param in params:
+        if id(param) not in seen:
+            seen.add(id(param))
+            unique.append(param)
+    return unique
+
+
+def _normalize_params(params_to_optimize) -> list:
+    """
+    Materialize the params into a list, dropping tensors that were passed more than once (e.g. by overlapping chained
+    iterables). Param groups keep their own options and order, as the trainer addresses them by index. Params that
+    don't require grad are kept, since the trainer toggles requires_grad on the text encoder during training.
+    """
+    params_to_optimize = list(params_to_optimize)
+    seen = set()
+    if params_to_optimize and isinstance(params_to_optimize[0], dict):
+        groups = []
+        for group in params_to_optimize:
+            group = dict(group)
+            group_params = group["params"]
+            if isinstance(group_params, torch.Tensor):
+                group_params = [group_params]
+            group["params"] = _unique_params(group_params, seen)
+            groups.append(group)
+        return groups
+    return _unique_params(params_to_optimize, seen)
+
+
+def _build_optimizer(
+        optimizer: str, learning_rate: float, weight_decay: float, params_to_optimize, shard_state: bool = False
+) -> Optimizer:
+    module, class_name, build = _OPTIMIZER_FACTORIES.get(optimizer, _OPTIMIZER_FACTORIES[_DEFAULT_OPTIMIZER])
+    optimizer_class = _cached_import(module, class_name)
+
+    def construct(params, **kwargs) -> Optimizer:
+        # Every optimizer takes the same params/lr/weight_decay, the factories only add their own options on top
+        return build(functools.partial(optimizer_class, params, **kwargs))
+
+    if shard_state:
+        return _shard_state(construct, params_to_optimize, learning_rate, weight_decay)
+    return construct(params_to_optimize, lr=learning_rate, weight_decay=weight_decay)
+
+
+def _bind_methods(optimizer: Optimizer, **methods: Callable) -> Optimizer:
+    # Bind as methods on the instance, LR schedulers wrap optimizer.step and expect a bound method
+    for name, method in methods.items():
+        setattr(optimizer, name, types.MethodType(method, optimizer))
+    return optimizer
+
+
+def _compile_step(optimizer: Optimizer) -> Optimizer:
+    """
+    Replace `optimizer.step` with a `torch.compile`d version so the pointwise parameter updates are fused into fewer
+    kernels. The eager step is used if torch is too old, or if the step can't be traced or compiled on its first run.
+    Dynamo treats the floats in param_groups as constants and recompiles whenever one changes, so this is only used for
+    torch optimizers with a constant LR. Other optimizers (e.g. D-Adaptation's `d`) update their groups every step.
+    """
+    if not hasattr(torch, "compile") or version.parse(torch.__version__).release < (2, 1):
+        logger.warning("Compiling the optimizer step requires torch 2.1 or newer, using the eager step.")
+        return optimizer
+    if type(optimizer).__module__.startswith("torch.distributed"):
+        logger.warning(f"{type(optimizer).__name__} syncs its shards between GPUs in each step, not compiling its step.")
+        return optimizer
+    if not type(optimizer).__module__.startswith("torch.optim"):
+        logger.warning(f"{type(optimizer).__name__} updates its param groups every step, not compiling its step.")
+        return optimizer
+    if optimizer.defaults.get("fused"):
+        logger.info(f"{type(optimizer).__name__} already uses a fused kernel, not compiling its step.")
+        return optimizer
+
+    from torch._dynamo.exc import BackendCompilerFailed, Unsupported
+
+    eager_step = optimizer.step
+    compiled_step = torch.compile(eager_step, fullgraph=False)
+    first_call = True
+
+    def step(self, *args, **kwargs):
+        nonlocal compiled_step, first_call
+        if compiled_step is None:
+            return eager_step(*args, **kwargs)
+        if not first_call:
+            return compiled_step(*args, **kwargs)
+
+        first_call = False
+        try:
+            return compiled_step(*args, **kwargs)
+        except (BackendCompilerFailed, Unsupported) as e:
+            # Raised while tracing or compiling, before the update ran. Anything else (e.g. an OOM) may have happened
+            # after some params were already updated, so running the eager step again would apply it twice.
+            logger.warning(f"Unable to compile the optimizer step, using the eager step: {e}")
+            compiled_step = None
+        return eager_step(*args, **kwargs)
+
+    return _bind_methods(optimizer, step=step)
+
+
+def _shard_state(
+        optimizer_class: Callable[..., Optimizer], params_to_optimize, learning_rate: float, weight_decay: float
+) -> Optimizer:
+    """
+    Build the optimizer as a `ZeroRedundancyOptimizer`, so each rank only keeps the state for its own shard of the
+    params. `optimizer_class` builds the optimizer for a single shard, with the same options as an unsharded one.
+    Only applies to distributed runs, the optimizer is built unsharded otherwise or if it can't be sharded.
+    Sharded state has to be consolidated on every rank before it can be saved.
+    """
+    if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+        return optimizer_class(params_to_optimize, lr=learning_rate, weight_decay=weight_decay)
+
+    from torch.distributed.optim import ZeroRedundancyOptimizer
+    try:
+        sharded = ZeroRedundancyOptimizer(
+            params_to_optimize,
+            optimizer_class=optimizer_class,
+            lr=learning_rate,
+            weight_decay=weight_decay,
+        )
+    except Exception as e:
+        logger.warning(f"Unable to shard the optimizer state, keeping it on every rank: {e}")
+        return optimizer_class(params_to_optimize, lr=learning_rate, weight_decay=weight_decay)
+
+    # D-Adaptation estimates its step size over all params, so it has to reduce it across the shards like under FSDP
+    for group in sharded.optim.param_groups:
+        if "fsdp_in_use" in group:
+            group["fsdp_in_use"] = True
+    return sharded
+
+
+def _offload_state(optimizer: Optimizer) -> Optimizer:
+    """
+    Keep the optimizer state in pinned host memory between steps, so it doesn't hold VRAM during the forward pass.
+    Each param's state is copied back to the GPU on a dedicated stream as soon as its grad has been accumulated, which
+    overlaps the copies with the rest of the backward pass, and is copied back to the host after the step.
+    This costs two PCIe transfers of the whole state per step, so it suits single-GPU runs that are short on VRAM.
+    With gradient accumulation the state is fetched on the first micro-batch and stays on the GPU until the step.
+    """
+    if not torch.cuda.is_available():
+        return optimizer
+    if torch.distributed.is_available():
+        from torch.distributed.optim import ZeroRedundancyOptimizer
+        if isinstance(optimizer, ZeroRedundancyOptimizer):
+            # The sharded wrapper keeps no state itself, the state for this rank's shard lives in the optimizer it wraps
+            _offload_state(optimizer.optim)
+            return optimizer
+    if type(optimizer).__module__.startswith("bitsandbytes"):
+        logger.warning(f"{type(optimizer).__name__} manages its own state memory, not offloading it.")
+        return optimizer
+
+    # A separate, high priority stream, so the copies don't queue behind compute on the default stream
+    copy_stream = torch.cuda.Stream(priority=-1)
+    host_buffers = {}
+    gpu_step = optimizer.step
+    gpu_state_dict = optimizer.state_dict
+
+    def prefetch(param):
+        state = optimizer.state.get(param)
+        if not state:
+            return
+        # Pinned tensors are the ones offloaded below, anything else already lives where it should
+        offloaded = [key for key, value in state.items() if isinstance(value, torch.Tensor) and value.is_pinned()]
+        if not offloaded:
+            return
+        # The GPU copies are allocated on the compute stream that uses them, so the copy stream has to wait for any
+        # queued kernels that still use the memory they get
+        gpu_values = {key: torch.empty_like(state[key], device=param.device) for key in offloaded}
+        copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(copy_stream):
+            for key, gpu_value in gpu_values.items():
+                gpu_value.copy_(state[key], non_blocking=True)
+        state.update(gpu_values)
+
+    if hasattr(torch.Tensor, "register_post_accumulate_grad_hook"):
+        for group in optimizer.param_groups:
+            for param in group["params"]:
+                if isinstance(param, torch.Tensor) and param.requires_grad:
+                    param.register_post_accumulate_grad_hook(prefetch)
+    else:
+        logger.info("Optimizer state prefetch requires torch 2.1 or newer, it is copied at the start of each step.")
+
+    def step(self, *args, **kwargs):
+        # Whatever the backward hooks didn't fetch, e.g. params that had no grad this step
+        for param in list(self.state.keys()):
+            prefetch(param)
+        torch.cuda.current_stream().wait_stream(copy_stream)
+
+        result = gpu_step(*args, **kwargs)
+
+        copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(copy_stream):
+            for param, state in self.state.items():
+                for key, value in state.items():
+                    if not isinstance(value, torch.Tensor) or not value.is_cuda:
+                        continue
+                    buffer = host_buffers.get((param, key))
+                    if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+                        buffer = torch.empty_like(value, device="cpu", pin_memory=True)
+                        host_buffers[(param, key)] = buffer
+                    buffer.copy_(value, non_blocking=True)
+                    # The GPU copy is released below, keep its memory reserved until the copy has run
+                    value.record_stream(copy_stream)
+                    state[key] = buffer
+        return result
+
+    def state_dict(self):
+        # Make sure the host copies are complete before they're read
+        copy_stream.synchronize()
+        return gpu_state_dict()
+
+    return _bind_methods(optimizer, step=step, state_dict=state_dict)
+
+
+def get_optimizer(
+        optimizer: str,
+        learning_rate: float,
+        weight_decay: float,
+        params_to_optimize,
+        compile_step: bool = False,
+        shard_state: bool = False,
+        offload_state: bool = False,
+        constant_lr: bool = False,
+):
+    params_to_optimize = _normalize_params(params_to_optimize)
+    try:
+        opt = _build_optimizer(optimizer, learning_rate, weight_decay, params_to_optimize, shard_state)
+
+    except Exception as e:
+        # Only report the full failure once per optimizer, it won't change until the webui is restarted
+        if optimizer not in _reported_failures:
+            _reported_failures.add(optimizer)
+            logger.warning(f"Exception importing {optimizer}, using default optimizer (AdamW from Torch): {e}",
+                           exc_info=True)
+        else:
+            logger.warning(f"Unable to use {optimizer}, using default optimizer (AdamW from Torch).")
+        optimizer = _DEFAULT_OPTIMIZER
+        opt = _build_optimizer(optimizer, learning_rate, weight_decay, params_to_optimize, shard_state)
+
+    if compile_step and not constant_lr:
+        logger.warning("The optimizer step is only compiled with a constant LR, every LR change would recompile it.")
+    elif compile_step and offload_state:
+        # The offloaded state is new tensors every step, which would fail dynamo's guards every time
+        logger.warning("The optimizer step can't be compiled while its state is offloaded, using the eager step.")
+    elif compile_step:
+        opt = _compile_step(opt)
+    if offload_state:
+        opt = _offload_state(opt)
+    return opt
+
+
+# Noise scheduler setting -> diffusers class name, anything else trains with DDPM
+_NOISE_SCHEDULERS = {
+    "DEIS": "DEISMultistepScheduler",
+    "UniPC": "UniPCMultistepScheduler",
+}
+
+
+@functools.lru_cache(maxsize=16)
+def _load_scheduler_config(scheduler_class, path: str, mtime: Optional[float]) -> dict:
+    # mtime is only part of the cache key, so a model re-extracted to the same path is read again
+    return scheduler_class.load_config(path, subfolder="scheduler")
+
+
+def get_noise_scheduler(args):
+    scheduler_class = _cached_import("diffusers", _NOISE_SCHEDULERS.get(args.noise_scheduler, "DDPMScheduler"))
+    model_path = args.get_pretrained_model_name_or_path()
+    config_file = os.path.join(model_path, "scheduler", scheduler_class.config_name)
+    mtime = os.path.getmtime(config_file) if os.path.isfile(config_file) else None
+
+    # Build a new scheduler every time, callers are free to change its state
+    config = _load_scheduler_config(scheduler_class, model_path, mtime)
+    return scheduler_class.from_config(copy.deepcopy(config))
@@ -680,7 +680,26 @@ def main(class_gen_method: str = "Native Diffusers", user: str = None) -> TrainR
             else:
                 params_to_optimize = unet.parameters()
 
-            optimizer = get_optimizer(args.optimizer, learning_rate, args.weight_decay, params_to_optimize)
+            shard_optimizer = args.shard_optimizer
+            if shard_optimizer and (args.save_state_during or args.save_state_after or args.save_state_cancel):
+                # Snapshots are saved from the main process only, sharded state can't be gathered there
+                logger.warning("Optimizer state can't be sharded when saving snapshots, keeping it on every GPU.")
+                shard_optimizer = False
+
+            # A compiled optimizer step has to be rebuilt for every new LR, so it's only used when the LR never changes
+            constant_lr = (args.lr_scheduler == "constant" and args.lr_factor == 1.0) or (
+                    args.lr_scheduler == "constant_with_warmup" and args.lr_warmup_steps == 0
+            )
+            optimizer = get_optimizer(
+                args.optimizer,
+                learning_rate,
+                args.weight_decay,
+                params_to_optimize,
+                compile_step=args.compile_optimizer,
+                shard_state=shard_optimizer,
+                offload_state=args.offload_optimizer_state,
+                constant_lr=constant_lr,
+            )
             if len(optimizer.param_groups) > 1:
                 try:
                     optimizer.param_groups[1]["weight_decay"] = args.tenc_weight_decay
@@ -211,6 +211,7 @@ let db_titles = {
     "Classification Image Negative Prompt": "A negative prompt to use when generating class images. Can be empty.",
     "Classification Steps": "The number of steps to use when generating classifier/regularization images.",
     "Clip Skip": "Use output of nth layer from back of text encoder (n>=1)",
+    "Compile Optimizer Step": "Use torch.compile on the optimizer update. Requires torch 2.1 or newer, and the first step is slower while it compiles. Only applies to Torch AdamW without its fused kernel (older GPUs), with a constant learning rate and without offloading the optimizer state.",
     "Concepts List": "The path to the concepts JSON file, or a JSON string.",
     "Constant/Linear Starting Factor": "Sets the initial learning rate to the main_lr * this value. If you had a target LR of .000006 and set this to .5, the scheduler would start at .000003 and increase until it reached .000006.",
     "Create From Hub": "Import a model from Huggingface.co instead of using a local checkpoint. Hub model MUST contain diffusion weights. You can specify a local folder with a cloned model, no HF token will be needed in this case.",
@@ -276,6 +277,7 @@ let db_titles = {
     "Noise scheduler": "The algorithm used to generate noise used in the diffusion process.",
     "Number of Hard Resets": "Number of hard resets of the lr in cosine_with_restarts scheduler.",
     "Number of Samples to Generate": "How many samples to generate per subject.",
+    "Offload Optimizer State to CPU": "Keep the optimizer state in system RAM between steps and copy it to the GPU for each update. Frees VRAM for larger batches at the cost of slower steps. Not used with 8bit optimizers.",
     "Offset Noise": "Allows the model to learn brightness and contrast with greater detail during training. Value controls the strength of the effect, 0 disables it.",
     "Optimizer": "Optimizer algorithm.\nRecommended settings (LR = Learning Rate, WD = Weight Decay):\nTorch / 8Bit AdamW - LR: 2e-6, WD: 0.01\nLion - LR: 5e-7, WD: 0.02\nAdamW Adapt - LR: 0.05, WD: 0\nLion Adapt - LR: ??, WD:0\nSGD Adapt - LR: 1, WD: 0\nAdan Adapt - LR: 0.2, WD: 0.01",
     "Pad Tokens": "Pad the input images token length to this amount. You probably want to do this.",
@@ -308,6 +310,7 @@ let db_titles = {
     "Save EMA Weights to Generated Models": "If a model was extracted or trained with EMA weights, these will be appended separately to the model for use in training later.",
     "Scale Position": "The percent in training where the 'final' learning rate should be achieved. If training at 100 epochs and this is set to 0.25, the final LR will be reached at epoch 25.",
     "Set Gradients to None When Zeroing": "When performing the backwards pass, gradients will be set to none, instead of creating a new empty tensor. This will slightly improve VRAM.",
+    "Shard Optimizer State": "When training on multiple GPUs, split the optimizer state between them instead of keeping a full copy on each GPU. Ignored on a single GPU, and when saving snapshots.",
     "Shuffle After Epoch": "When enabled, will shuffle the dataset after the first epoch. Will enable text encoder training and latent caching (More VRAM).",
     "Shuffle Tags": "When enabled, tags after the first ',' in a prompt will be randomly ordered, which can potentially improve training.",
     "Source Checkpoint": "The source checkpoint to extract for training.",
@@ -570,6 +570,15 @@ def on_ui_tabs():
                             value="8bit AdamW",
                             choices=list_optimizer(),
                         )
+                        db_compile_optimizer = gr.Checkbox(
+                            label="Compile Optimizer Step", value=False
+                        )
+                        db_shard_optimizer = gr.Checkbox(
+                            label="Shard Optimizer State", value=False
+                        )
+                        db_offload_optimizer_state = gr.Checkbox(
+                            label="Offload Optimizer State to CPU", value=False
+                        )
                         db_mixed_precision = gr.Dropdown(
                             label="Mixed Precision",
                             value=select_precision(),
@@ -1469,6 +1478,7 @@ def on_ui_tabs():
             db_attention,
             db_cache_latents,
             db_clip_skip,
+            db_compile_optimizer,
             db_concepts_path,
             db_custom_model_name,
             db_deterministic,
@@ -1513,6 +1523,7 @@ def on_ui_tabs():
             db_model_path,
             db_noise_scheduler,
             db_num_train_epochs,
+            db_offload_optimizer_state,
             db_offset_noise,
             db_optimizer,
             db_pad_tokens,
@@ -1541,6 +1552,7 @@ def on_ui_tabs():
             db_save_state_cancel,
             db_save_state_during,
             db_scheduler,
+            db_shard_optimizer,
             db_shared_diffusers_path,
             db_shuffle_tags,
             db_snapshot,